@@ -1,26 +1,31 @@
 import os
-import json
 import asyncio
+import functools
+import hashlib
+import hmac
+import json
 import logging
-from collections import defaultdict
+import random
+import signal
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
 from io import BytesIO
-from datetime import datetime, timedelta
-import matplotlib.dates as mdates
-from matplotlib.ticker import FuncFormatter
+from datetime import timedelta
 import time
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 import httpx
-import matplotlib.pyplot as plt
+import orjson
 import numpy as np
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
-    Application, MessageHandler, CommandHandler, ContextTypes, filters, CallbackQueryHandler
+    AIORateLimiter, Application, MessageHandler, CommandHandler, ContextTypes, filters, CallbackQueryHandler
 )
-from telegram.error import NetworkError, TimedOut
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
 from telegram.request import HTTPXRequest
 
 # Carrega .env ANTES de importar db
@@ -28,15 +33,15 @@ load_dotenv()
 
 from db import (
     insert_expense,
+    insert_many,
     list_last_expenses,
     list_last_entries,
-    totals_by_category,
-    totals_overall,
+    report_bundle,
+    bulk_totals,
     daily_totals_last_n_days,
     monthly_balance,
     weekly_balance_last_n_weeks,
-    list_users_with_expenses,
-    get_chat_id_for_user,
+    list_users_and_chat_ids,
     delete_last_entry,
 )
 from utils import (
@@ -47,6 +52,11 @@ from utils import (
     week_range_local,
     format_brl,
     format_reply,
+    escape_html,
+    TTLCache,
+    TokenBucket,
+    may_have_amount,
+    fast_extract,
 )
 
 
@@ -66,29 +76,91 @@ MODEL = "llama-3.3-70b-versatile"
 # ── Rate limiting ──────────────────────────────────────────────
 RATE_LIMIT_MSGS = int(os.getenv("RATE_LIMIT_MSGS", "5"))   # msgs por janela
 RATE_LIMIT_WINDOW = int(os.getenv("RATE_LIMIT_WINDOW", "60"))  # janela em segundos
-_user_timestamps: dict[int, list[float]] = defaultdict(list)
+# Token bucket por usuario: checagem O(1) e memoria limitada (LRU)
+RATE_LIMIT_RATE = RATE_LIMIT_MSGS / RATE_LIMIT_WINDOW  # fichas por segundo
+RATE_LIMIT_MAX_USERS = 10_000
+_buckets: OrderedDict[int, TokenBucket] = OrderedDict()
 
 def is_rate_limited(user_id: int) -> bool:
-    now = time.time()
-    window_start = now - RATE_LIMIT_WINDOW
-    timestamps = _user_timestamps[user_id]
-    _user_timestamps[user_id] = [t for t in timestamps if t > window_start]
-    if len(_user_timestamps[user_id]) >= RATE_LIMIT_MSGS:
-        return True
-    _user_timestamps[user_id].append(now)
-    return False
+    now = time.monotonic()
+    bucket = _buckets.get(user_id)
+    if bucket is None:
+        bucket = _buckets[user_id] = TokenBucket(RATE_LIMIT_MSGS, now)
+        if len(_buckets) > RATE_LIMIT_MAX_USERS:
+            _buckets.popitem(last=False)
+    else:
+        _buckets.move_to_end(user_id)
+    return not bucket.consume(RATE_LIMIT_RATE, RATE_LIMIT_MSGS, now)
+
+# Com REDIS_URL o limite vira compartilhado entre instancias e sobrevive a
+# restarts: janela fixa com SET NX EX + INCR numa transacao (um round-trip).
+# Sem REDIS_URL (ou se o Redis cair) usa o token bucket local acima.
+REDIS_URL = os.getenv("REDIS_URL", "").strip() or None
+# Timeouts curtos: com o Redis travado a mensagem cai no limite local em
+# fracao de segundo, em vez de esperar o timeout TCP do sistema. Depois de
+# uma falha o Redis fica de lado por REDIS_RETRY_AFTER segundos (um aviso
+# so no log por queda).
+REDIS_TIMEOUT = 0.3
+REDIS_RETRY_AFTER = 30.0
+_REDIS = None
+_REDIS_DOWN_UNTIL = 0.0
+
+async def start_redis() -> None:
+    global _REDIS
+    if REDIS_URL and _REDIS is None:
+        import redis.asyncio as redis  # so e necessario com REDIS_URL
+        _REDIS = redis.Redis.from_url(
+            REDIS_URL,
+            socket_connect_timeout=REDIS_TIMEOUT,
+            socket_timeout=REDIS_TIMEOUT,
+        )
+
+async def close_redis() -> None:
+    global _REDIS
+    if _REDIS is not None:
+        await _REDIS.aclose()
+        _REDIS = None
+
+async def check_rate_limit(user_id: int) -> bool:
+    global _REDIS_DOWN_UNTIL
+    if _REDIS is None or time.monotonic() < _REDIS_DOWN_UNTIL:
+        return is_rate_limited(user_id)
+    key = f"rl:{user_id}"
+    try:
+        async with _REDIS.pipeline(transaction=True) as pipe:
+            _, count = await pipe.set(key, 0, ex=RATE_LIMIT_WINDOW, nx=True).incr(key).execute()
+    except Exception as e:
+        if not _REDIS_DOWN_UNTIL:
+            logger.warning("Redis indisponivel, usando rate limit local: %s", e)
+        _REDIS_DOWN_UNTIL = time.monotonic() + REDIS_RETRY_AFTER
+        return is_rate_limited(user_id)
+    if _REDIS_DOWN_UNTIL:
+        logger.info("Redis de volta, rate limit compartilhado de novo")
+        _REDIS_DOWN_UNTIL = 0.0
+    return count > RATE_LIMIT_MSGS
 
 # ── Allowlist de usuarios ─────────────────────────────────────
+# IDs ordenados num array de int64 contiguo (8 bytes por ID) com busca binaria;
+# um set de ints custa bem mais memoria quando a lista cresce.
 _allowed_env = os.getenv("ALLOWED_USERS", "").strip()
-ALLOWED_USERS: set[int] | None = (
-    {int(uid.strip()) for uid in _allowed_env.split(",") if uid.strip()}
+ALLOWED_USERS: array | None = (
+    array("q", sorted({int(uid.strip()) for uid in _allowed_env.split(",") if uid.strip()}))
     if _allowed_env else None  # None = qualquer um pode usar
 )
 
 def is_allowed(user_id: int) -> bool:
     if ALLOWED_USERS is None:
         return True
-    return user_id in ALLOWED_USERS
+    i = bisect_left(ALLOWED_USERS, user_id)
+    return i < len(ALLOWED_USERS) and ALLOWED_USERS[i] == user_id
+
+# Comandos de diagnostico (/cachestats) so para estes IDs; vazio = ninguem
+ADMIN_USERS = frozenset(
+    int(uid.strip()) for uid in os.getenv("ADMIN_USERS", "").split(",") if uid.strip()
+)
+
+def is_admin(user_id: int) -> bool:
+    return user_id in ADMIN_USERS
 
 # ── Validacao de entrada ──────────────────────────────────────
 MAX_TEXT_LENGTH = 500
@@ -113,157 +185,435 @@ Regras:
 - currency sempre "BRL".
 """
 
+# ── Cliente HTTP da Groq ──────────────────────────────────────
+# Um unico AsyncClient reaproveita conexoes (keep-alive) entre mensagens,
+# evitando um handshake TCP+TLS novo a cada chamada. E criado no post_init
+# (dentro do event loop do bot) e fechado no post_shutdown.
+_GROQ_CLIENT: httpx.AsyncClient | None = None
+
+async def _get_client() -> httpx.AsyncClient:
+    # Sem lock: criar o client nao tem await, entao nenhuma outra task roda
+    # entre o teste e a atribuicao.
+    global _GROQ_CLIENT
+    if _GROQ_CLIENT is None:
+        _GROQ_CLIENT = httpx.AsyncClient(
+            http2=True,
+            headers={
+                "Authorization": f"Bearer {GROQ_API_KEY}",
+                "Content-Type": "application/json",
+            },
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=64,
+                max_keepalive_connections=32,
+                keepalive_expiry=60,
+            ),
+        )
+    return _GROQ_CLIENT
+
+async def close_groq_client() -> None:
+    global _GROQ_CLIENT
+    if _GROQ_CLIENT is not None:
+        await _GROQ_CLIENT.aclose()
+        _GROQ_CLIENT = None
+
+
+# Partes fixas do payload, montadas uma vez so
+_SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT.strip()}
+_BASE_PAYLOAD = {
+    "model": MODEL,
+    "temperature": 0,
+    "response_format": {"type": "json_object"},
+    "stream": False,  # resposta unica em JSON, nunca SSE
+}
+# O corpo ja serializado ate a mensagem de sistema (o prompt e a maior parte
+# do payload); a cada chamada so a mensagem do usuario e codificada e
+# emendada antes do "]}" final.
+_PAYLOAD_HEAD = orjson.dumps(_BASE_PAYLOAD | {"messages": [_SYSTEM_MESSAGE]})[:-2]
 
-async def extract_expense(text: str) -> dict:
-    payload = {
-        "model": MODEL,
-        "temperature": 0,
-        "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT.strip()},
-            {"role": "user", "content": text.strip()},
-        ],
-        "response_format": {"type": "json_object"},
-    }
 
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json",
-    }
+def _groq_body(text: str) -> bytes:
+    return b"".join((
+        _PAYLOAD_HEAD, b",", orjson.dumps({"role": "user", "content": text.strip()}), b"]}",
+    ))
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.post(GROQ_URL, headers=headers, json=payload)
-        r.raise_for_status()
-        data = r.json()
+
+async def extract_expense(text: str) -> dict:
+    client = await _get_client()
+    r = await client.post(GROQ_URL, content=_groq_body(text))
+    r.raise_for_status()
+    data = orjson.loads(r.content)
 
     content = data["choices"][0]["message"]["content"]
-    return json.loads(content)
+    return _parse_llm_json(content)
+
+_LENIENT_PARSES = 0
+
+def _parse_llm_json(content: str):
+    """
+    orjson no caminho normal; se falhar, tenta o json da stdlib em modo
+    nao estrito (aceita quebra de linha crua dentro de strings, NaN etc.)
+    e, por ultimo, json5 (aspas simples, virgula sobrando, comentarios).
+    """
+    global _LENIENT_PARSES
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        pass
 
-async def safe_send(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str) -> None:
-    for attempt, delay in enumerate([1, 2, 4], start=1):
+    _LENIENT_PARSES += 1
+    logger.warning("Resposta da IA fora do JSON estrito (%s ate agora): %r", _LENIENT_PARSES, content[:200])
+    try:
+        return json.loads(content, strict=False)
+    except json.JSONDecodeError:
+        import json5  # lento, mas so roda quando o modelo erra o formato
+        return json5.loads(content)
+
+# ── Cache das extracoes ───────────────────────────────────────
+# Frases se repetem muito ("uber 20", "almocei 35") e com temperature=0 a
+# resposta e a mesma: um LRU pelo texto normalizado evita a ida ate a Groq.
+LLM_CACHE_SIZE = 4096
+_LLM_CACHE: OrderedDict[str, dict] = OrderedDict()
+_LLM_STATS = {"hits": 0, "misses": 0}
+# Chamadas em andamento por texto normalizado: a mesma frase chegando duas
+# vezes antes da Groq responder (duplo envio, varios usuarios) espera a
+# primeira chamada em vez de abrir outra.
+_LLM_INFLIGHT: dict[str, asyncio.Task] = {}
+
+def _normalize_prompt(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+def _llm_done(key: str, task: asyncio.Task) -> None:
+    _LLM_INFLIGHT.pop(key, None)
+    if task.cancelled() or task.exception() is not None:
+        return
+    obj = task.result()
+    if isinstance(obj, dict):
+        _LLM_CACHE[key] = dict(obj)
+        if len(_LLM_CACHE) > LLM_CACHE_SIZE:
+            _LLM_CACHE.popitem(last=False)
+
+async def extract_expense_cached(text: str) -> dict:
+    key = _normalize_prompt(text)
+    cached = _LLM_CACHE.get(key)
+    if cached is not None:
+        _LLM_CACHE.move_to_end(key)
+        _LLM_STATS["hits"] += 1
+        return dict(cached)  # copia: quem chama pode alterar o dict
+
+    task = _LLM_INFLIGHT.get(key)
+    if task is None:
+        _LLM_STATS["misses"] += 1
+        task = asyncio.ensure_future(extract_expense(text))
+        _LLM_INFLIGHT[key] = task
+        task.add_done_callback(functools.partial(_llm_done, key))
+    else:
+        _LLM_STATS["hits"] += 1
+    # shield: se um dos que esperam for cancelado, a chamada segue pros demais
+    obj = await asyncio.shield(task)
+    return dict(obj) if isinstance(obj, dict) else obj
+
+SEND_ATTEMPTS = 4
+
+def _retry_delay(attempt: int) -> float:
+    """Backoff exponencial com jitter, pra retries de varios usuarios nao sairem juntos."""
+    return min(30.0, 2 ** attempt + random.random())
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+async def safe_send(
+    context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, parse_mode: str | None = "HTML",
+) -> bool:
+    """parse_mode=None pra texto puro (sem tags), que o Telegram nem precisa parsear."""
+    for attempt in range(SEND_ATTEMPTS):
         try:
-            await context.bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
-            return
+            await context.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+            return True
+        except RetryAfter as e:
+            logger.warning("Telegram pediu pra esperar %ss (tentativa %s)", e.retry_after, attempt + 1)
+            if attempt < SEND_ATTEMPTS - 1:
+                await asyncio.sleep(_retry_after_seconds(e))
+        except BadRequest as e:
+            # subclasse de NetworkError, mas permanente (chat inexistente,
+            # HTML invalido): repetir so segura o slot do envio das 23h
+            logger.warning("Telegram recusou msg para %s: %s", chat_id, e)
+            return False
         except (NetworkError, TimedOut) as e:
-            logger.warning("Falha ao enviar msg (tentativa %s): %s", attempt, e)
-            await asyncio.sleep(delay)
+            logger.warning("Falha ao enviar msg (tentativa %s): %s", attempt + 1, e)
+            if attempt < SEND_ATTEMPTS - 1:
+                await asyncio.sleep(_retry_delay(attempt))
         except Exception as e:
             logger.exception("Erro inesperado ao enviar msg: %s", e)
-            return
+            return False
+    return False
 
-async def safe_send_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, data: bytes, caption: str = "") -> None:
-    for attempt, delay in enumerate([1, 2, 4], start=1):
+async def safe_send_photo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, data: bytes, caption: str = "") -> bool:
+    bio = BytesIO(data)
+    bio.name = "grafico.webp"
+    for attempt in range(SEND_ATTEMPTS):
         try:
-            bio = BytesIO(data)
-            bio.name = "grafico.png"
+            bio.seek(0)
             await context.bot.send_photo(chat_id=chat_id, photo=bio, caption=caption)
-            return
+            return True
+        except RetryAfter as e:
+            logger.warning("Telegram pediu pra esperar %ss (tentativa %s)", e.retry_after, attempt + 1)
+            if attempt < SEND_ATTEMPTS - 1:
+                await asyncio.sleep(_retry_after_seconds(e))
+        except BadRequest as e:
+            # subclasse de NetworkError, mas permanente (chat inexistente,
+            # HTML invalido): repetir so segura o slot do envio das 23h
+            logger.warning("Telegram recusou foto para %s: %s", chat_id, e)
+            return False
         except (NetworkError, TimedOut) as e:
-            logger.warning("Falha ao enviar foto (tentativa %s): %s", attempt, e)
-            await asyncio.sleep(delay)
+            logger.warning("Falha ao enviar foto (tentativa %s): %s", attempt + 1, e)
+            if attempt < SEND_ATTEMPTS - 1:
+                await asyncio.sleep(_retry_delay(attempt))
         except Exception as e:
             logger.exception("Erro inesperado ao enviar foto: %s", e)
-            return
+            return False
+    return False
 
+# ── Cache de relatorios/graficos ──────────────────────────────
+# /teste23, o job das 23:00 e /relatorio seguido de /grafico montam a mesma
+# coisa em sequencia. Guardamos o resultado por (user_id, janela de ttl) e
+# invalidamos o usuario quando ele salva ou remove um registro. Os graficos
+# sao bem mais caros (matplotlib), entao ficam 5 min no cache.
+# A chave tambem leva uma "epoca" do usuario, incrementada a cada escrita:
+# um render que comecou antes da escrita grava na epoca antiga e nunca e
+# servido depois dela.
+_REPORT_CACHE = TTLCache(ttl=60, maxsize=256)
+_CHART_CACHE = TTLCache(ttl=300, maxsize=128)
+_USER_EPOCH: dict[str, int] = {}
+
+def cached_per_window(cache: TTLCache):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(user_id: str, *args, **kwargs):
+            key = (
+                user_id, _USER_EPOCH.get(user_id, 0), int(time.time() // cache.ttl),
+                args, tuple(sorted(kwargs.items())),
+            )
+            result = cache.get(key)
+            if result is None:
+                result = fn(user_id, *args, **kwargs)
+                cache.set(key, result)
+            return result
+        return wrapper
+    return decorator
+
+def invalidate_user_cache(user_id: str) -> None:
+    _USER_EPOCH[user_id] = _USER_EPOCH.get(user_id, 0) + 1
+    _REPORT_CACHE.invalidate_user(user_id)
+    _CHART_CACHE.invalidate_user(user_id)
+
+def cache_stats() -> dict[str, tuple[int, int, int]]:
+    """(hits, misses, tamanho) de cada cache."""
+    return {
+        name: (cache.hits, cache.misses, len(cache))
+        for name, cache in (("relatorios", _REPORT_CACHE), ("graficos", _CHART_CACHE))
+    }
+
+async def log_cache_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    for name, (hits, misses, size) in cache_stats().items():
+        logger.info("Cache de %s: %s hits, %s misses, %s itens", name, hits, misses, size)
+
+@cached_per_window(_REPORT_CACHE)
 def build_report_text(user_id: str) -> str:
     d0 = now_local()
     d_start, d_end = day_range_local(d0)
     w_start, w_end = week_range_local(d0)
 
-    day_total, day_n = totals_overall(user_id, d_start, d_end)
-    week_total, week_n = totals_overall(user_id, w_start, w_end)
+    b = report_bundle(user_id, d_start, d_end, w_start, w_end)
+    return format_report_text(
+        d_start, w_start,
+        b["day_total"], b["day_n"], b["week_total"], b["week_n"],
+        b["day_rows"], b["week_rows"],
+    )
 
-    day_rows = totals_by_category(user_id, d_start, d_end)
-    week_rows = totals_by_category(user_id, w_start, w_end)
+_CAT_EMOJI_DEFAULT = "📦"
 
-    lines = []
+def _category_lines(rows, empty: str) -> str:
+    """Ate 8 categorias, uma por linha; `empty` quando nao ha nenhuma."""
+    emoji_of = CATEGORY_EMOJI.get
+    return "\n".join(
+        f"    {emoji_of(cat, _CAT_EMOJI_DEFAULT)} {escape_html(cat)}: <code>{format_brl(total)}</code> ({n})"
+        for cat, total, n in rows[:8]
+    ) or f"    <i>{empty}</i>"
 
-    # ── Hoje ──
-    lines.append(f"📅 <b>Hoje</b> ({d_start.strftime('%d/%m')})")
-    lines.append(f"    💰 Total: <b>{format_brl(day_total)}</b>  •  {day_n} gasto(s)")
-    lines.append("")
-    if day_rows:
-        for cat, total, n in day_rows[:8]:
-            emoji = CATEGORY_EMOJI.get(cat, "📦")
-            lines.append(f"    {emoji} {cat}: <code>{format_brl(total)}</code> ({n})")
-    else:
-        lines.append("    <i>Nenhum gasto hoje</i>")
-
-    lines.append("")
-    lines.append("─────────────────────")
-    lines.append("")
-
-    # ── Semana ──
-    lines.append(f"🗓 <b>Semana</b> (desde {w_start.strftime('%d/%m')})")
-    lines.append(f"    💰 Total: <b>{format_brl(week_total)}</b>  •  {week_n} gasto(s)")
-    lines.append("")
-    if week_rows:
-        for cat, total, n in week_rows[:8]:
-            emoji = CATEGORY_EMOJI.get(cat, "📦")
-            lines.append(f"    {emoji} {cat}: <code>{format_brl(total)}</code> ({n})")
-    else:
-        lines.append("    <i>Nenhum gasto na semana</i>")
+def format_report_text(d_start, w_start, day_total, day_n, week_total, week_n, day_rows, week_rows) -> str:
+    day_section = _category_lines(day_rows, "Nenhum gasto hoje")
+    week_section = _category_lines(week_rows, "Nenhum gasto na semana")
+
+    return (
+        # ── Hoje ──
+        f"📅 <b>Hoje</b> ({d_start.strftime('%d/%m')})\n"
+        f"    💰 Total: <b>{format_brl(day_total)}</b>  •  {day_n} gasto(s)\n"
+        f"\n"
+        f"{day_section}\n"
+        f"\n"
+        f"─────────────────────\n"
+        f"\n"
+        # ── Semana ──
+        f"🗓 <b>Semana</b> (desde {w_start.strftime('%d/%m')})\n"
+        f"    💰 Total: <b>{format_brl(week_total)}</b>  •  {week_n} gasto(s)\n"
+        f"\n"
+        f"{week_section}"
+    )
+
+def build_entries_text(title: str, rows) -> str:
+    """
+    Monta a listagem de /gastos e /ganhos: titulo + um bloco por registro.
+    """
+    emoji_of = CATEGORY_EMOJI.get
+    entries = "\n\n".join(
+        f"{i}. {emoji_of(category, '📦')} <b>{format_brl(amount)}</b> — {escape_html(category)}\n"
+        f"     <i>{escape_html(description)}</i>\n"
+        f"     🕐 <code>{created_at.strftime('%d/%m %H:%M')}</code>"
+        for i, (created_at, amount, currency, category, description) in enumerate(rows, 1)
+    )
+    return f"{title}\n\n{entries}"
+
+# ── Figuras reaproveitadas ────────────────────────────────────
+# Montar uma figura nova a cada grafico e caro; mantemos uma por tipo de
+# grafico por thread (threading.local), limpamos os eixos entre renders e
+# cada thread so mexe nas suas figuras, sem precisar de lock.
+# Usamos Figure + FigureCanvasAgg direto (sem pyplot): nada de registro
+# global de figuras, o que deixa o render seguro fora da thread principal.
+#
+# O matplotlib so e importado no primeiro grafico (_load_matplotlib): o
+# import custa centenas de ms e dezenas de MB, e a maioria das execucoes
+# (e dos reinicios do main) nunca chega a desenhar nada.
+CHART_BG_COLOR = "#FAFBFC"
+CHART_GRID_COLOR = "#E5E7EB"
+CHART_TEXT_COLOR = "#374151"
+
+# 12x5 pol. a 110 dpi ja e nitido no Telegram (que recomprime a imagem).
+# Enviamos WebP com perdas: ~2.5x menor que o PNG e mais rapido de codificar
+# no method=0 (o mais rapido do libwebp).
+CHART_DPI = 110
+CHART_IMAGE_KWARGS = {"quality": 85, "method": 0}
+
+mdates = Figure = FigureCanvasAgg = _BRL_FMT = None
+_MPL_LOCK = threading.Lock()
+
+def _load_matplotlib() -> None:
+    """Importa o matplotlib (uma vez so) e prepara o formatter BRL do eixo Y."""
+    global mdates, Figure, FigureCanvasAgg, _BRL_FMT
+    if _BRL_FMT is not None:
+        return
+    with _MPL_LOCK:
+        if _BRL_FMT is not None:
+            return
+        import matplotlib.dates as _mdates
+        from matplotlib.backends.backend_agg import FigureCanvasAgg as _Canvas
+        from matplotlib.figure import Figure as _Figure
+        from matplotlib.ticker import FuncFormatter
+
+        mdates, Figure, FigureCanvasAgg = _mdates, _Figure, _Canvas
+        _BRL_FMT = FuncFormatter(lambda v, _: format_brl(v))
+
+# O dpi e as cores ficam na propria figura, entao a imagem sai direto do
+# canvas (print_webp), sem o caminho generico do savefig.
+def _new_chart_figure():
+    fig = Figure(figsize=(12, 5), dpi=CHART_DPI, facecolor=CHART_BG_COLOR, edgecolor="none")
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.set_facecolor(CHART_BG_COLOR)
+    return fig, ax
+
+def _apply_chart_style(ax, bg: str = CHART_BG_COLOR) -> None:
+    """Fundo, grid horizontal sutil, sem bordas (exceto a inferior), ticks limpos e eixo Y em BRL."""
+    ax.set_facecolor(bg)
+    ax.yaxis.set_major_formatter(_BRL_FMT)
+    ax.grid(True, axis="y", linestyle="-", linewidth=0.5, color=CHART_GRID_COLOR, alpha=0.8)
+    ax.grid(False, axis="x")
+    ax.spines["top"].set_visible(False)
+    ax.spines["right"].set_visible(False)
+    ax.spines["left"].set_visible(False)
+    ax.spines["bottom"].set_color(CHART_GRID_COLOR)
+    ax.spines["bottom"].set_linewidth(0.8)
+    ax.tick_params(axis="both", which="both", length=0, labelcolor=CHART_TEXT_COLOR, labelsize=9)
 
-    return "\n".join(lines)
+_CHART_TLS = threading.local()
 
+def _chart_figure(kind: str):
+    """(fig, ax) do tipo de grafico `kind` ("daily"/"balance") desta thread."""
+    figs = _CHART_TLS.__dict__.setdefault("figs", {})
+    if kind not in figs:
+        _load_matplotlib()
+        figs[kind] = _new_chart_figure()
+    return figs[kind]
+
+# Pool proprio pro render: dois workers (cada um com suas figuras), sem
+# disputar as threads do to_thread usadas pelas consultas.
+_CHART_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chart")
+
+def _daily_stats(y: np.ndarray) -> tuple[float, float, float, np.ndarray]:
+    """
+    Reducoes do grafico diario numa passada so: total, media dos dias com
+    gasto, maior valor e indices dos (ate) 5 maiores dias com gasto.
+    """
+    if not y.size:
+        return 0.0, 0.0, 0.0, np.empty(0, dtype=np.intp)
+    pos = np.flatnonzero(y > 0)
+    if not pos.size:
+        return float(y.sum()), 0.0, float(y.max()), pos
+    k = min(5, pos.size)
+    top = pos[np.argpartition(-y[pos], k - 1)[:k]]
+    return float(y.sum()), float(y[pos].mean()), float(y.max()), top
+
+@cached_per_window(_CHART_CACHE)
 def build_daily_chart_png(user_id: str, days: int = 30) -> bytes:
     end = now_local()
     start = (end - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
 
     rows = daily_totals_last_n_days(user_id, days=days + 5, start_dt=start, end_dt=end)
 
-    # mapa dia -> total
-    totals_by_day = {r[0].date(): float(r[1] or 0) for r in rows}
+    # serie completa (linha continua), um ponto por dia
+    x_all = np.arange(
+        np.datetime64(start.date()), np.datetime64(end.date()) + 1, dtype="datetime64[D]"
+    )
+    y_all = np.zeros(x_all.size, dtype=np.float64)
 
-    # serie completa (linha continua)
-    x_all = []
-    y_all = []
-    cur = start.date()
-    while cur <= end.date():
-        x_all.append(cur)
-        y_all.append(totals_by_day.get(cur, 0.0))
-        cur = cur + timedelta(days=1)
+    # espalha os totais do banco nas posicoes dos seus dias
+    if rows:
+        days_db = np.array([r[0] for r in rows], dtype="datetime64[D]")
+        idx = (days_db - x_all[0]).astype(np.intp)
+        ok = (idx >= 0) & (idx < x_all.size)
+        y_all[idx[ok]] = np.fromiter(
+            (float(r[1] or 0) for r in rows), dtype=np.float64, count=len(rows)
+        )[ok]
 
     # pontos com gasto (para marcadores)
-    x_pts = [d for d in x_all if totals_by_day.get(d, 0.0) > 0]
-    y_pts = [totals_by_day[d] for d in x_pts]
+    mask = y_all > 0
+    x_pts = x_all[mask]
+    y_pts = y_all[mask]
+    total, media, maior, top = _daily_stats(y_all)
 
     # ── Cores e estilo ──
     COLOR_LINE = "#2563EB"       # azul moderno
     COLOR_FILL = "#2563EB"
     COLOR_DOT = "#1D4ED8"
-    COLOR_GRID = "#E5E7EB"
-    COLOR_TEXT = "#374151"
+    COLOR_TEXT = CHART_TEXT_COLOR
     COLOR_LABEL_BG = "#F0F4FF"
-    BG_COLOR = "#FAFBFC"
+    BG_COLOR = CHART_BG_COLOR
 
-    fig, ax = plt.subplots(figsize=(12, 5))
-    fig.set_facecolor(BG_COLOR)
-    ax.set_facecolor(BG_COLOR)
+    fig, ax = _chart_figure("daily")
+    ax.cla()
+    fig.texts.clear()
 
     # ── Linha principal com area preenchida ──
     ax.plot(x_all, y_all, linewidth=2.5, color=COLOR_LINE, zorder=3)
     ax.fill_between(x_all, y_all, alpha=0.08, color=COLOR_FILL, zorder=2)
 
     # ── Marcadores elegantes so onde tem gasto ──
-    if x_pts:
+    if mask.any():
         ax.scatter(x_pts, y_pts, s=30, color=COLOR_DOT, zorder=4, edgecolors="white", linewidths=1.5)
 
-    # ── Eixo Y: formato BRL ──
-    ax.yaxis.set_major_formatter(FuncFormatter(lambda x, pos: format_brl(x)))
-
-    # ── Grid sutil apenas horizontal ──
-    ax.grid(True, axis="y", linestyle="-", linewidth=0.5, color=COLOR_GRID, alpha=0.8)
-    ax.grid(False, axis="x")
-
-    # ── Remover bordas (spines) exceto inferior ──
-    ax.spines["top"].set_visible(False)
-    ax.spines["right"].set_visible(False)
-    ax.spines["left"].set_visible(False)
-    ax.spines["bottom"].set_color(COLOR_GRID)
-    ax.spines["bottom"].set_linewidth(0.8)
-
-    # ── Ticks limpos ──
-    ax.tick_params(axis="both", which="both", length=0, labelcolor=COLOR_TEXT, labelsize=9)
+    # ── Eixo Y em BRL, grid, bordas e ticks ──
+    _apply_chart_style(ax, BG_COLOR)
 
     # ── Titulo minimalista ──
     ax.set_title(
@@ -273,16 +623,26 @@ def build_daily_chart_png(user_id: str, days: int = 30) -> bytes:
     )
 
     # ── Eixo X: mostrar mais datas ──
-    locator = mdates.AutoDateLocator(minticks=6, maxticks=15)
+    # Pro caso comum (ate ~45 dias) os ticks sao fixos a cada 4 dias do mes,
+    # o mesmo que o AutoDateLocator escolheria, sem a busca de candidatos.
+    if days <= 45:
+        locator = mdates.DayLocator(bymonthday=range(1, 32, 4))
+    else:
+        locator = mdates.AutoDateLocator(minticks=6, maxticks=15)
     ax.xaxis.set_major_locator(locator)
     ax.xaxis.set_major_formatter(mdates.DateFormatter("%d/%m"))
-    fig.autofmt_xdate(rotation=45, ha="right")
+    # rotacao direto nos rotulos (o tight_layout abaixo ja ajusta as margens,
+    # entao nao precisamos do relayout do autofmt_xdate)
+    for label in ax.get_xticklabels():
+        label.set_rotation(45)
+        label.set_ha("right")
 
     # ── Escala Y ──
-    positives = sorted([v for v in y_all if v > 0])
-    if positives:
-        median = positives[len(positives) // 2]
-        vmax = positives[-1]
+    if y_pts.size:
+        # selecao parcial: so precisamos do elemento do meio, nao da serie ordenada
+        mid = y_pts.size // 2
+        median = np.partition(y_pts, mid)[mid]
+        vmax = maior
         if median > 0 and (vmax / median) >= 8:
             ax.set_yscale("symlog", linthresh=10)
         else:
@@ -291,36 +651,26 @@ def build_daily_chart_png(user_id: str, days: int = 30) -> bytes:
         ax.set_ylim(0, 1)
 
     # ── Rotulos nos top 5 valores ──
-    if x_pts:
-        pairs = list(zip(x_pts, y_pts))
-        pairs_sorted = sorted(pairs, key=lambda t: t[1], reverse=True)
-        to_label = pairs_sorted[:5]
-
-        for xd, yd in to_label:
-            ax.annotate(
-                format_brl(yd),
-                (xd, yd),
-                textcoords="offset points",
-                xytext=(0, 12),
-                ha="center",
-                fontsize=8,
-                fontweight="bold",
-                color=COLOR_TEXT,
-                bbox=dict(
-                    boxstyle="round,pad=0.3",
-                    fc=COLOR_LABEL_BG,
-                    ec=COLOR_LINE,
-                    linewidth=0.6,
-                    alpha=0.9,
-                ),
-            )
+    for xd, yd in zip(x_all[top].tolist(), y_all[top].tolist()):
+        ax.annotate(
+            format_brl(yd),
+            (xd, yd),
+            textcoords="offset points",
+            xytext=(0, 12),
+            ha="center",
+            fontsize=8,
+            fontweight="bold",
+            color=COLOR_TEXT,
+            bbox=dict(
+                boxstyle="round,pad=0.3",
+                fc=COLOR_LABEL_BG,
+                ec=COLOR_LINE,
+                linewidth=0.6,
+                alpha=0.9,
+            ),
+        )
 
     # ── Resumo no rodape ──
-    total = sum(y_all)
-    dias_com_gasto = len([v for v in y_all if v > 0])
-    media = total / dias_com_gasto if dias_com_gasto > 0 else 0
-    maior = max(y_all) if y_all else 0
-
     resumo = (
         f"Total: {format_brl(total)}"
         f"   |   Media/dia: {format_brl(media)}"
@@ -336,8 +686,7 @@ def build_daily_chart_png(user_id: str, days: int = 30) -> bytes:
     fig.subplots_adjust(bottom=0.13)
 
     bio = BytesIO()
-    fig.savefig(bio, format="png", dpi=180, facecolor=BG_COLOR, edgecolor="none")
-    plt.close(fig)
+    fig.canvas.print_webp(bio, pil_kwargs=CHART_IMAGE_KWARGS)
     return bio.getvalue()
 
 
@@ -367,38 +716,26 @@ async def gastos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_allowed(update.effective_user.id):
         return
     user_id = str(update.effective_user.id)
-    rows = list_last_expenses(user_id=user_id, limit=10)
+    rows = await asyncio.to_thread(list_last_expenses, user_id=user_id, limit=10)
 
     if not rows:
         await safe_send(context, update.effective_chat.id, "📭 <i>Nenhum gasto registrado ainda.</i>")
         return
 
-    lines = ["📋 <b>Últimos gastos</b>\n"]
-    for i, (created_at, amount, currency, category, description) in enumerate(rows, 1):
-        dt = str(created_at)[:16].replace("T", " ")
-        emoji = CATEGORY_EMOJI.get(category, "📦")
-        lines.append(
-            f"{i}. {emoji} <b>{format_brl(amount)}</b> — {category}\n"
-            f"     <i>{description}</i>\n"
-            f"     🕐 <code>{dt}</code>"
-        )
-        if i < len(rows):
-            lines.append("")
-
-    await safe_send(context, update.effective_chat.id, "\n".join(lines))
+    await safe_send(context, update.effective_chat.id, build_entries_text("📋 <b>Últimos gastos</b>", rows))
 
 async def relatorio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_allowed(update.effective_user.id):
         return
     user_id = str(update.effective_user.id)
-    text = build_report_text(user_id)
+    text = await asyncio.to_thread(build_report_text, user_id)
     await safe_send(context, update.effective_chat.id, text)
 
 async def grafico(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_allowed(update.effective_user.id):
         return
     user_id = str(update.effective_user.id)
-    png = build_daily_chart_png(user_id, days=30)
+    png = await build_daily_chart_png_async(user_id, 30)
     await safe_send_photo(context, update.effective_chat.id, png, caption="📈 Gastos por dia (30 dias)")
 
 async def teste23(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -410,35 +747,33 @@ async def teste23(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(update.effective_user.id)
     chat_id = update.effective_chat.id
 
-    text = build_report_text(user_id)
+    text = await asyncio.to_thread(build_report_text, user_id)
     await safe_send(context, chat_id, "🧪 <b>Teste do relatório (simulando 23:00)</b>\n\n" + text)
 
-    png = build_daily_chart_png(user_id, days=30)
+    png = await build_daily_chart_png_async(user_id, 30)
     await safe_send_photo(context, chat_id, png, caption="📈 Gráfico (30 dias) — teste")
 
+async def cachestats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin(update.effective_user.id):
+        return
+    lines = [
+        f"🧠 IA: {_LLM_STATS['hits']} hits, {_LLM_STATS['misses']} misses, {len(_LLM_CACHE)} itens",
+    ]
+    for name, (hits, misses, size) in cache_stats().items():
+        lines.append(f"📦 {name}: {hits} hits, {misses} misses, {size} itens")
+    await safe_send(context, update.effective_chat.id, "\n".join(lines), parse_mode=None)
+
 async def ganhos(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_allowed(update.effective_user.id):
         return
     user_id = str(update.effective_user.id)
-    rows = list_last_entries(user_id, entry_type="income", limit=10)
+    rows = await asyncio.to_thread(list_last_entries, user_id, entry_type="income", limit=10)
 
     if not rows:
         await safe_send(context, update.effective_chat.id, "📭 <i>Nenhum ganho registrado ainda.</i>")
         return
 
-    lines = ["💚 <b>Últimos ganhos</b>\n"]
-    for i, (created_at, amount, currency, category, description) in enumerate(rows, 1):
-        dt = str(created_at)[:16].replace("T", " ")
-        emoji = CATEGORY_EMOJI.get(category, "📦")
-        lines.append(
-            f"{i}. {emoji} <b>{format_brl(amount)}</b> — {category}\n"
-            f"     <i>{description}</i>\n"
-            f"     🕐 <code>{dt}</code>"
-        )
-        if i < len(rows):
-            lines.append("")
-
-    await safe_send(context, update.effective_chat.id, "\n".join(lines))
+    await safe_send(context, update.effective_chat.id, build_entries_text("💚 <b>Últimos ganhos</b>", rows))
 
 
 async def saldo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -451,8 +786,8 @@ async def saldo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     m_start = d0.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     m_end = d0 + timedelta(days=1)
 
-    total_gastos, n_gastos, total_ganhos, n_ganhos = monthly_balance(user_id, m_start, m_end)
-    saldo_val = float(total_ganhos) - float(total_gastos)
+    total_gastos, n_gastos, total_ganhos, n_ganhos = await asyncio.to_thread(monthly_balance, user_id, m_start, m_end)
+    saldo_val = total_ganhos - total_gastos  # Decimal; format_brl converte
 
     if saldo_val >= 0:
         saldo_icon = "🟢"
@@ -476,6 +811,7 @@ async def saldo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await safe_send(context, update.effective_chat.id, text)
 
 
+@cached_per_window(_CHART_CACHE)
 def build_balance_chart_png(user_id: str, weeks: int = 8) -> bytes:
     """Grafico de barras: gastos x ganhos por semana + linha de saldo."""
     end = now_local()
@@ -483,32 +819,27 @@ def build_balance_chart_png(user_id: str, weeks: int = 8) -> bytes:
 
     rows = weekly_balance_last_n_weeks(user_id, weeks=weeks + 2, start_dt=start, end_dt=end)
 
-    week_labels = []
-    expenses = []
-    incomes = []
-    for row in rows:
-        week_labels.append(row[0].strftime("%d/%m"))
-        expenses.append(float(row[1] or 0))
-        incomes.append(float(row[2] or 0))
+    week_labels = [row[0].strftime("%d/%m") for row in rows]
+    expenses = np.fromiter((float(row[1] or 0) for row in rows), dtype=np.float64, count=len(rows))
+    incomes = np.fromiter((float(row[2] or 0) for row in rows), dtype=np.float64, count=len(rows))
 
     # Cores
     COLOR_EXPENSE = "#EF4444"
     COLOR_INCOME = "#22C55E"
     COLOR_BALANCE = "#2563EB"
-    COLOR_GRID = "#E5E7EB"
-    COLOR_TEXT = "#374151"
-    BG_COLOR = "#FAFBFC"
+    COLOR_GRID = CHART_GRID_COLOR
+    COLOR_TEXT = CHART_TEXT_COLOR
+    BG_COLOR = CHART_BG_COLOR
 
-    fig, ax = plt.subplots(figsize=(12, 5))
-    fig.set_facecolor(BG_COLOR)
-    ax.set_facecolor(BG_COLOR)
+    fig, ax = _chart_figure("balance")
+    ax.cla()
+    fig.texts.clear()
 
     if not week_labels:
         ax.text(0.5, 0.5, "Sem dados ainda", ha="center", va="center",
                 fontsize=14, color=COLOR_TEXT, transform=ax.transAxes)
         bio = BytesIO()
-        fig.savefig(bio, format="png", dpi=180, facecolor=BG_COLOR)
-        plt.close(fig)
+        fig.canvas.print_webp(bio, pil_kwargs=CHART_IMAGE_KWARGS)
         return bio.getvalue()
 
     x = np.arange(len(week_labels))
@@ -519,7 +850,7 @@ def build_balance_chart_png(user_id: str, weeks: int = 8) -> bytes:
     bars_inc = ax.bar(x + width/2, incomes, width, label="Ganhos", color=COLOR_INCOME, alpha=0.85, zorder=3)
 
     # Linha de saldo
-    balances = [inc - exp for inc, exp in zip(incomes, expenses)]
+    balances = incomes - expenses
     ax.plot(x, balances, color=COLOR_BALANCE, linewidth=2.5, marker="o", markersize=6,
             label="Saldo", zorder=4, markeredgecolor="white", markeredgewidth=1.5)
 
@@ -537,7 +868,7 @@ def build_balance_chart_png(user_id: str, weeks: int = 8) -> bytes:
                     ha="center", va="bottom", fontsize=7, color=COLOR_INCOME, fontweight="bold")
 
     # Rotulos de saldo
-    for i, bal in enumerate(balances):
+    for i, bal in enumerate(balances.tolist()):
         offset = 12 if bal >= 0 else -12
         ax.annotate(
             format_brl(bal),
@@ -549,16 +880,8 @@ def build_balance_chart_png(user_id: str, weeks: int = 8) -> bytes:
     # Estilo
     ax.set_xticks(x)
     ax.set_xticklabels([f"Sem.\n{l}" for l in week_labels], fontsize=8)
-    ax.yaxis.set_major_formatter(FuncFormatter(lambda v, pos: format_brl(v)))
     ax.axhline(y=0, color=COLOR_GRID, linewidth=1, zorder=1)
-    ax.grid(True, axis="y", linestyle="-", linewidth=0.5, color=COLOR_GRID, alpha=0.8)
-    ax.grid(False, axis="x")
-
-    ax.spines["top"].set_visible(False)
-    ax.spines["right"].set_visible(False)
-    ax.spines["left"].set_visible(False)
-    ax.spines["bottom"].set_color(COLOR_GRID)
-    ax.tick_params(axis="both", which="both", length=0, labelcolor=COLOR_TEXT, labelsize=9)
+    _apply_chart_style(ax, BG_COLOR)
 
     ax.set_title(
         f"Gastos x Ganhos — ultimas {weeks} semanas",
@@ -568,8 +891,8 @@ def build_balance_chart_png(user_id: str, weeks: int = 8) -> bytes:
     ax.legend(loc="upper left", frameon=False, fontsize=10)
 
     # Resumo
-    total_exp = sum(expenses)
-    total_inc = sum(incomes)
+    total_exp = float(expenses.sum())
+    total_inc = float(incomes.sum())
     saldo_total = total_inc - total_exp
     resumo = f"Total gastos: {format_brl(total_exp)}   |   Total ganhos: {format_brl(total_inc)}   |   Saldo: {format_brl(saldo_total)}"
     fig.text(0.5, 0.01, resumo, ha="center", fontsize=9, color=COLOR_TEXT, alpha=0.7, style="italic")
@@ -578,16 +901,24 @@ def build_balance_chart_png(user_id: str, weeks: int = 8) -> bytes:
     fig.subplots_adjust(bottom=0.15)
 
     bio = BytesIO()
-    fig.savefig(bio, format="png", dpi=180, facecolor=BG_COLOR, edgecolor="none")
-    plt.close(fig)
+    fig.canvas.print_webp(bio, pil_kwargs=CHART_IMAGE_KWARGS)
     return bio.getvalue()
 
 
+async def build_daily_chart_png_async(user_id: str, days: int = 30) -> bytes:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_CHART_POOL, build_daily_chart_png, user_id, days)
+
+async def build_balance_chart_png_async(user_id: str, weeks: int = 8) -> bytes:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_CHART_POOL, build_balance_chart_png, user_id, weeks)
+
+
 async def balanco(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_allowed(update.effective_user.id):
         return
     user_id = str(update.effective_user.id)
-    png = build_balance_chart_png(user_id, weeks=8)
+    png = await build_balance_chart_png_async(user_id, 8)
     await safe_send_photo(context, update.effective_chat.id, png, caption="📊 Gastos x Ganhos (8 semanas)")
 
 
@@ -601,7 +932,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_allowed(uid):
         return
 
-    if is_rate_limited(uid):
+    if await check_rate_limit(uid):
         await safe_send(
             context, update.effective_chat.id,
             "⏳ Calma! Limite de mensagens atingido. Tente novamente em alguns segundos.",
@@ -615,8 +946,14 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
+    if not may_have_amount(text_in):
+        # sem nenhuma pista de valor: responde direto, sem chamar a IA
+        await safe_send(context, update.effective_chat.id, format_reply({"amount": None}))
+        return
+
     try:
-        obj = await extract_expense(text_in)
+        # frases simples ("gastei 50 no uber") nem passam pela IA
+        obj = fast_extract(text_in) or await extract_expense_cached(text_in)
         amount = obj.get("amount")
 
         if amount is not None:
@@ -658,6 +995,79 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await safe_send(context, update.effective_chat.id, f"❌ Erro: {type(e).__name__}")
 
 
+# ── Gravacao em segundo plano ─────────────────────────────────
+# O botao "Confirmar" so enfileira o registro; uma task unica grava em lote
+# (executemany) sem segurar a resposta ao usuario.
+INSERT_BATCH_SIZE = 64
+INSERT_QUEUE_SIZE = 1024
+REMOVE_FLUSH_TIMEOUT = 5  # /remover espera a fila no maximo isso (segundos)
+_INSERT_Q: asyncio.Queue[dict] = asyncio.Queue(maxsize=INSERT_QUEUE_SIZE)
+_INSERT_WRITER: asyncio.Task | None = None
+
+async def _store_batch(app: Application, batch: list[dict]) -> None:
+    """
+    Grava o lote; se o executemany falhar, tenta registro a registro pra que
+    um item ruim (ou uma falha passageira) nao derrube os demais. Quem ainda
+    falhar recebe um aviso no chat, ja que o botao mostrou "Salvo".
+    """
+    failed: list[dict] = []
+    try:
+        await asyncio.to_thread(insert_many, batch)
+    except Exception as e:
+        logger.warning("Falha ao gravar lote de %s registro(s), tentando um a um: %s", len(batch), e)
+        for row in batch:
+            try:
+                await asyncio.to_thread(insert_expense, **row)
+            except Exception as e:
+                logger.exception("Falha ao gravar registro de %s: %s", row["user_id"], e)
+                failed.append(row)
+
+    for row in batch:
+        invalidate_user_cache(row["user_id"])
+
+    for row in failed:
+        try:
+            chat_id = int(row["chat_id"])
+        except (TypeError, ValueError):
+            continue
+        # safe_send so usa .bot, que o Application tambem tem
+        await safe_send(
+            app, chat_id,
+            f"❌ <b>Não consegui salvar</b> {format_brl(row['amount'])} "
+            f"({escape_html(row['category'])}). Manda de novo, por favor.",
+        )
+
+async def _insert_writer(app: Application) -> None:
+    while True:
+        batch = [await _INSERT_Q.get()]
+        while len(batch) < INSERT_BATCH_SIZE and not _INSERT_Q.empty():
+            batch.append(_INSERT_Q.get_nowait())
+        try:
+            await _store_batch(app, batch)
+        except Exception as e:
+            logger.exception("Falha ao gravar %s registro(s): %s", len(batch), e)
+        finally:
+            for _ in batch:
+                _INSERT_Q.task_done()
+
+def start_insert_writer(app: Application) -> None:
+    global _INSERT_Q, _INSERT_WRITER
+    # fila nova a cada start: main() recria o event loop quando reinicia
+    _INSERT_Q = asyncio.Queue(maxsize=INSERT_QUEUE_SIZE)
+    _INSERT_WRITER = asyncio.create_task(_insert_writer(app), name="insert_writer")
+
+async def stop_insert_writer() -> None:
+    global _INSERT_WRITER
+    if _INSERT_WRITER is None:
+        return
+    try:
+        await asyncio.wait_for(_INSERT_Q.join(), timeout=10)
+    except asyncio.TimeoutError:
+        logger.warning("Encerrando com %s registro(s) sem gravar.", _INSERT_Q.qsize())
+    _INSERT_WRITER.cancel()
+    _INSERT_WRITER = None
+
+
 async def confirm_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -671,7 +1081,7 @@ async def confirm_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         obj = pending["obj"]
         user_id = str(update.effective_user.id)
 
-        insert_expense(
+        row = dict(
             user_id=user_id,
             chat_id=pending["chat_id"],
             raw_text=pending["raw_text"],
@@ -682,6 +1092,12 @@ async def confirm_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             confidence=float(obj.get("confidence") or 0),
             entry_type=obj.get("type", "expense"),
         )
+        try:
+            _INSERT_Q.put_nowait(row)
+        except asyncio.QueueFull:
+            # fila cheia: grava direto, sem perder o registro
+            await asyncio.to_thread(insert_expense, **row)
+            invalidate_user_cache(user_id)
         await query.edit_message_text(query.message.text_html + "\n\n✅ <b>Salvo com sucesso!</b>", parse_mode="HTML")
     else:
         await query.edit_message_text(query.message.text_html + "\n\n❌ <b>Cancelado.</b>", parse_mode="HTML")
@@ -693,7 +1109,18 @@ async def remover(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_allowed(update.effective_user.id):
         return
     user_id = str(update.effective_user.id)
-    removed = delete_last_entry(user_id)
+    # garante que registros ainda na fila ja foram gravados antes de apagar;
+    # com o banco lento/fora o writer fica tentando, entao a espera e limitada
+    try:
+        await asyncio.wait_for(_INSERT_Q.join(), timeout=REMOVE_FLUSH_TIMEOUT)
+    except asyncio.TimeoutError:
+        await safe_send(
+            context, update.effective_chat.id,
+            "⏳ <b>Ainda estou gravando registros.</b> Não deu pra confirmar a remoção, tenta de novo daqui a pouco.",
+        )
+        return
+    removed = await asyncio.to_thread(delete_last_entry, user_id)
+    invalidate_user_cache(user_id)
 
     if not removed:
         await safe_send(context, update.effective_chat.id, "📭 <i>Nenhum registro encontrado para remover.</i>")
@@ -705,53 +1132,262 @@ async def remover(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         f"🗑️ <b>Registro removido!</b>\n\n"
         f"Tipo: {tipo}\n"
         f"Valor: {format_brl(amount)}\n"
-        f"Categoria: {category}\n"
-        f"Desc: <i>{description}</i>"
+        f"Categoria: {escape_html(category)}\n"
+        f"Desc: <i>{escape_html(description or '')}</i>"
     )
     await safe_send(context, update.effective_chat.id, msg)
 
 
+# ── Health check + webhook ────────────────────────────────────
+# Servidor HTTP minimo rodando no proprio event loop do bot (sem thread
+# extra). Responde GET/HEAD em / e /healthz e, com WEBHOOK_URL definido,
+# recebe os updates do Telegram via POST em WEBHOOK_PATH na mesma porta.
+_HEALTH_PATHS = (b"/", b"/healthz")
+_HEALTH_SERVER: asyncio.AbstractServer | None = None
+
+# Webhook (opcional): o Telegram empurra cada update assim que chega, sem o
+# ciclo de long polling. O segredo vai no header X-Telegram-Bot-Api-Secret-Token;
+# sem WEBHOOK_SECRET, deriva um do token do bot.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/") or None
+WEBHOOK_PATH = b"/telegram"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or hashlib.sha256(
+    TELEGRAM_BOT_TOKEN.encode()
+).hexdigest()[:32]
+_WEBHOOK_SECRET_B = WEBHOOK_SECRET.encode()
+WEBHOOK_MAX_BODY = 1 << 20  # updates de texto/callback ficam bem abaixo disso
+_WEBHOOK_APP: Application | None = None
+
+# Respostas fixas, montadas uma vez so
+_HEALTH_OK_HEAD = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/plain; charset=utf-8\r\n"
+    b"Content-Length: 2\r\n"
+    b"Connection: close\r\n\r\n"
+)
+_HEALTH_OK = _HEALTH_OK_HEAD + b"ok"
+_HEALTH_NOT_FOUND = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+_HTTP_OK_EMPTY = b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+_HTTP_BAD_REQUEST = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+_HTTP_FORBIDDEN = b"HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+async def _handle_webhook(reader: asyncio.StreamReader) -> bytes:
+    """Le cabecalhos e corpo de um POST do Telegram e enfileira o update."""
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout=5)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower()] = value.strip()
+
+    if not hmac.compare_digest(headers.get(b"x-telegram-bot-api-secret-token", b""), _WEBHOOK_SECRET_B):
+        return _HTTP_FORBIDDEN
+    length = int(headers.get(b"content-length", b"0"))
+    if not 0 < length <= WEBHOOK_MAX_BODY:
+        return _HTTP_BAD_REQUEST
+    body = await asyncio.wait_for(reader.readexactly(length), timeout=10)
+
+    data = orjson.loads(body)
+    if not isinstance(data, dict):
+        return _HTTP_BAD_REQUEST
+    try:
+        update = Update.de_json(data, _WEBHOOK_APP.bot)
+        if update is None:  # null/{} viram None no de_json
+            return _HTTP_BAD_REQUEST
+        # responde logo: o processamento segue pela fila do PTB, como no polling
+        await _WEBHOOK_APP.update_queue.put(update)
+    except Exception as e:
+        logger.warning("Update invalido no webhook: %s", e)
+        return _HTTP_BAD_REQUEST
+    return _HTTP_OK_EMPTY
+
+async def _handle_health(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        parts = request_line.split()
+        method, path = (parts[0], parts[1]) if len(parts) >= 2 else (b"", b"")
+        path = path.split(b"?", 1)[0]  # ignora query string (?probe=1 etc.)
+
+        if method == b"GET" and path in _HEALTH_PATHS:
+            writer.write(_HEALTH_OK)
+        elif method == b"HEAD" and path in _HEALTH_PATHS:
+            writer.write(_HEALTH_OK_HEAD)
+        elif method == b"POST" and path == WEBHOOK_PATH and _WEBHOOK_APP is not None:
+            try:
+                writer.write(await _handle_webhook(reader))
+            except (ValueError, EOFError):  # Content-Length/JSON invalidos, corpo incompleto
+                writer.write(_HTTP_BAD_REQUEST)
+        else:
+            writer.write(_HEALTH_NOT_FOUND)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_health_server() -> None:
+    global _HEALTH_SERVER
+    port = int(os.getenv("PORT", "8080"))
+    _HEALTH_SERVER = await asyncio.start_server(_handle_health, "0.0.0.0", port)
+    print(f"Health server em http://0.0.0.0:{port}/healthz")
+
+async def stop_health_server() -> None:
+    global _HEALTH_SERVER
+    if _HEALTH_SERVER is not None:
+        _HEALTH_SERVER.close()
+        await _HEALTH_SERVER.wait_closed()
+        _HEALTH_SERVER = None
+
+async def run_webhook(app: Application) -> None:
+    """
+    Equivalente ao run_polling pro modo webhook: sobe o app, registra o
+    webhook no Telegram e fica servindo ate SIGINT/SIGTERM. Os updates
+    chegam pelo servidor acima (sem o extra [webhooks]/tornado do PTB).
+    """
+    global _WEBHOOK_APP
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    try:
+        _WEBHOOK_APP = app
+        await post_init(app)
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH.decode(),
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await app.start()
+        await stop.wait()
+        await app.stop()
+    finally:
+        _WEBHOOK_APP = None
+        await app.shutdown()
+        await post_shutdown(app)
+
+
+async def post_init(app: Application) -> None:
+    start_insert_writer(app)
+    await _get_client()
+    await start_redis()
+
+
+async def post_shutdown(app: Application) -> None:
+    await stop_insert_writer()
+    await close_groq_client()
+    await close_redis()
+
+
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.exception("Erro no handler: %s", context.error)
 
+# Quantos usuarios o job das 23:00 atende ao mesmo tempo. Fica bem abaixo
+# do pool de conexoes do bot com o Telegram pra nao esgota-lo.
+SCHEDULED_CONCURRENCY = int(os.getenv("SCHEDULED_CONCURRENCY", "16"))
+
 async def scheduled_23h(context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Envia automaticamente às 23:00 um resumo do dia + semana.
     (Para cada user_id que já tenha chat_id salvo)
     """
-    user_ids = list_users_with_expenses(only_with_chat_id=True)
-
-    for uid in user_ids:
-        try:
-            chat_id = get_chat_id_for_user(uid)
-            if not chat_id:
-                logger.warning("Usuário %s sem chat_id salvo. Pulando.", uid)
-                continue
-
-            text = build_report_text(uid)
-            await safe_send(
-                context,
-                chat_id,
-                "🕚 <b>Relatório automático (23:00)</b>\n\n" + text
-            )
+    sem = asyncio.Semaphore(SCHEDULED_CONCURRENCY)
 
-            # opcional: manda gráfico também
-            png = build_daily_chart_png(uid, days=30)
-            await safe_send_photo(context, chat_id, png, caption="📈 Gráfico (30 dias)")
+    # Usuarios + chat_id e os totais de todos de uma vez (3 consultas no total,
+    # em vez de 5 por usuario)
+    d0 = now_local()
+    d_start, d_end = day_range_local(d0)
+    w_start, w_end = week_range_local(d0)
+    users, (day_totals, day_cats), (week_totals, week_cats) = await asyncio.gather(
+        asyncio.to_thread(list_users_and_chat_ids),
+        asyncio.to_thread(bulk_totals, d_start, d_end),
+        asyncio.to_thread(bulk_totals, w_start, w_end),
+    )
 
-        except Exception as e:
-            logger.exception("Falha ao enviar relatório automático para %s: %s", uid, e)
+    async def _deliver(uid: str, raw_chat_id: str) -> bool:
+        try:
+            chat_id = int(raw_chat_id)
+        except (TypeError, ValueError):
+            logger.warning("Usuário %s sem chat_id válido. Pulando.", uid)
+            return False
+
+        async with sem:
+            # o grafico renderiza enquanto o texto e montado e enviado
+            chart = asyncio.ensure_future(build_daily_chart_png_async(uid, 30))
+            try:
+                text = format_report_text(
+                    d_start, w_start,
+                    *day_totals.get(uid, (0, 0)),
+                    *week_totals.get(uid, (0, 0)),
+                    day_cats.get(uid, []),
+                    week_cats.get(uid, []),
+                )
+                sent = await safe_send(
+                    context,
+                    chat_id,
+                    "🕚 <b>Relatório automático (23:00)</b>\n\n" + text
+                )
+            except BaseException:
+                chart.cancel()
+                raise
+
+            if not sent:
+                # usuario bloqueou o bot / chat invalido: nem espera o grafico
+                chart.cancel()
+                return False
+
+            # opcional: manda gráfico também; falha aqui nao desfaz o relatorio
+            try:
+                png = await chart
+                await safe_send_photo(context, chat_id, png, caption="📈 Gráfico (30 dias)")
+            except Exception as e:
+                logger.warning("Gráfico das 23:00 falhou para %s: %s", uid, e)
+            return True
+
+    started = time.monotonic()
+    results = await asyncio.gather(*(_deliver(uid, cid) for uid, cid in users), return_exceptions=True)
+    for (uid, _), res in zip(users, results):
+        if isinstance(res, Exception):
+            logger.error("Falha ao enviar relatório automático para %s: %s", uid, res, exc_info=res)
+    logger.info(
+        "Relatório das 23:00: %s de %s usuário(s) em %.1fs",
+        sum(res is True for res in results), len(users), time.monotonic() - started,
+    )
 
 
 def build_app() -> Application:
+    # Pools separados: o long polling (getUpdates) fica sempre com uma conexao
+    # so dele e o fan-out das 23:00 nao esgota o pool das chamadas da API.
+    # HTTP/2 nas chamadas normais: o fan-out das 23h multiplexa os envios
+    # numa conexao TLS so. O getUpdates (long polling, uma requisicao por
+    # vez) segue em HTTP/1.1.
     request = HTTPXRequest(
-        http_version="1.1",
+        connection_pool_size=32,
+        http_version="2",
         connect_timeout=20,
         read_timeout=20,
         write_timeout=20,
         pool_timeout=20,
     )
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).request(request).build()
+    get_updates_request = HTTPXRequest(
+        connection_pool_size=4,
+        http_version="1.1",
+        connect_timeout=20,
+        read_timeout=20,
+        write_timeout=20,
+        pool_timeout=30,
+    )
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .rate_limiter(AIORateLimiter())  # respeita o limite de ~30 msg/s do Telegram
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("gastos", gastos))
@@ -764,6 +1400,7 @@ def build_app() -> Application:
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
     app.add_handler(CallbackQueryHandler(confirm_btn, pattern="^conf_"))
     app.add_handler(CommandHandler("teste23", teste23))
+    app.add_handler(CommandHandler("cachestats", cachestats))
 
     app.add_error_handler(on_error)
 
@@ -775,71 +1412,54 @@ def build_app() -> Application:
         name="relatorio_23h",
     )
 
-    return app
-
-def start_health_server():
-    port = int(os.getenv("PORT", "8080"))
-
-    class Handler(BaseHTTPRequestHandler):
-        def _send_ok_headers(self):
-            self.send_response(200)
-            self.send_header("Content-Type", "text/plain; charset=utf-8")
-            self.end_headers()
-
-        def do_HEAD(self):
-            if self.path in ("/", "/healthz"):
-                self._send_ok_headers()
-            else:
-                self.send_response(404)
-                self.end_headers()
-
-        def do_GET(self):
-            if self.path in ("/", "/healthz"):
-                self._send_ok_headers()
-                self.wfile.write(b"ok")
-            else:
-                self.send_response(404)
-                self.end_headers()
-
-        def log_message(self, format, *args):
-            return  # silencia log
-
-    server = HTTPServer(("0.0.0.0", port), Handler)
-    t = threading.Thread(target=server.serve_forever, daemon=True)
-    t.start()
-    print(f"Health server em http://0.0.0.0:{port}/healthz")
+    app.job_queue.run_repeating(log_cache_stats, interval=3600, name="cache_stats")
 
+    return app
 
 def main() -> None:
     logging.basicConfig(level=logging.INFO)
-    start_health_server()
     backoffs = [2, 5, 10, 20]
     i = 0
 
-    while True:
-        try:
-            # Garante event loop no Python 3.11 (Windows)
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-
-            app = build_app()
-            print("Bot rodando via polling... (CTRL+C para parar)")
-
-            # Deixa o PTB gerenciar o loop e fechar corretamente ao sair
-            app.run_polling(close_loop=True)
-            return
+    # Um loop so pro processo inteiro: o health server sobe antes de qualquer
+    # contato com o Telegram e continua respondendo durante o backoff; se
+    # ficasse preso ao ciclo do PTB, a plataforma derrubaria o container
+    # enquanto a rede nao volta.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(start_health_server())
 
-        except NetworkError as e:
-            wait = backoffs[min(i, len(backoffs) - 1)]
-            i += 1
-            logger.warning("Falha de rede ao iniciar. Tentando de novo em %ss: %s", wait, e)
-
-            # NÃO usar asyncio.run aqui (pra não bagunçar o loop)
-            time.sleep(wait)
-
-        except Exception as e:
-            logger.exception("Erro fatal ao iniciar: %s", e)
-            raise
+    try:
+        while True:
+            try:
+                app = build_app()
+                if WEBHOOK_URL:
+                    print(f"Bot rodando via webhook em {WEBHOOK_URL}... (CTRL+C para parar)")
+                    loop.run_until_complete(run_webhook(app))
+                    return
+
+                print("Bot rodando via polling... (CTRL+C para parar)")
+
+                # close_loop=False: o loop segue vivo pro health server e pro
+                # retry (o bootstrap do polling tambem apaga um webhook antigo)
+                app.run_polling(close_loop=False)
+                return
+
+            except NetworkError as e:
+                # jitter de 50%-150% pra instancias reiniciando juntas nao baterem juntas
+                wait = backoffs[min(i, len(backoffs) - 1)] * (0.5 + random.random())
+                i += 1
+                logger.warning("Falha de rede ao iniciar. Tentando de novo em %.1fs: %s", wait, e)
+
+                # espera rodando o loop, pro /healthz continuar respondendo
+                loop.run_until_complete(asyncio.sleep(wait))
+
+            except Exception as e:
+                logger.exception("Erro fatal ao iniciar: %s", e)
+                raise
+    finally:
+        loop.run_until_complete(stop_health_server())
+        loop.close()
 
 
 if __name__ == "__main__":
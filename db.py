@@ -1,22 +1,56 @@
 import os
 from datetime import datetime
 from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
 
-DATABASE_URL = os.getenv("DATABASE_URL")
-if not DATABASE_URL:
+from utils import TZ
+
+_DATABASE_URL_RAW = os.getenv("DATABASE_URL")
+if not _DATABASE_URL_RAW:
     raise RuntimeError("Faltou DATABASE_URL no .env")
 
-# Força psycopg v3
-if DATABASE_URL.startswith("postgresql://"):
-    DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+psycopg://", 1)
+# make_url entende usuario/senha com caracteres especiais e a query string,
+# sem depender de replace/substring na URL crua.
+DATABASE_URL = make_url(_DATABASE_URL_RAW).set(drivername="postgresql+psycopg")  # força psycopg v3
 
 # Supabase exige SSL
-if "sslmode=" not in DATABASE_URL:
-    sep = "&" if "?" in DATABASE_URL else "?"
-    DATABASE_URL = DATABASE_URL + f"{sep}sslmode=require"
+if "sslmode" not in DATABASE_URL.query:
+    DATABASE_URL = DATABASE_URL.update_query_dict({"sslmode": "require"})
+
+# Pool LIFO: em horario calmo as conexoes excedentes ficam ociosas e sao
+# recicladas, as quentes continuam no topo. O Supabase derruba conexoes
+# paradas, dai o pool_recycle. Tamanho e reciclagem vem do ambiente pra
+# caber no limite de conexoes do plano do Supabase.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+engine = create_engine(
+    DATABASE_URL,
+    pool_pre_ping=True,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_timeout=10,  # falha rapido em vez de segurar o handler 30s esperando conexao
+    pool_use_lifo=True,
+)
 
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# Consultas so de leitura rodam em autocommit (mesmo pool): um SELECT avulso
+# nao precisa de BEGIN/COMMIT, o que economiza duas idas ao banco por chamada.
+# engine.begin() fica so pra quem escreve.
+read_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
 
+# As consultas (text()) sao montadas uma vez so, no import, logo acima da
+# funcao que as usa: o text() varre o SQL atras dos :parametros a cada
+# construcao, e o cache de compilacao do SQLAlchemy reaproveita o mesmo objeto.
+
+_Q_INSERT_EXPENSE = text("""
+    insert into public.expenses
+        (user_id, chat_id, raw_text, amount, currency, category, description, confidence, type)
+    values
+        (:user_id, :chat_id, :raw_text, :amount, :currency, :category, :description, :confidence, :type)
+    returning id;
+""")
 
 def insert_expense(
     *,
@@ -33,15 +67,8 @@ def insert_expense(
     """
     Salva uma despesa ou ganho. entry_type: 'expense' ou 'income'.
     """
-    q = text("""
-        insert into public.expenses
-            (user_id, chat_id, raw_text, amount, currency, category, description, confidence, type)
-        values
-            (:user_id, :chat_id, :raw_text, :amount, :currency, :category, :description, :confidence, :type)
-        returning id;
-    """)
     with engine.begin() as conn:
-        row = conn.execute(q, {
+        row = conn.execute(_Q_INSERT_EXPENSE, {
             "user_id": user_id,
             "chat_id": chat_id,
             "raw_text": raw_text,
@@ -55,45 +82,40 @@ def insert_expense(
         return row[0] if row else None
 
 
-def get_chat_id_for_user(user_id: str) -> int | None:
+_Q_INSERT_MANY = text("""
+    insert into public.expenses
+        (user_id, chat_id, raw_text, amount, currency, category, description, confidence, type)
+    values
+        (:user_id, :chat_id, :raw_text, :amount, :currency, :category, :description, :confidence, :entry_type);
+""")
+
+def insert_many(rows: list[dict]) -> None:
     """
-    Pega o último chat_id conhecido do usuário.
+    Salva varios registros de uma vez (executemany). Cada item tem as mesmas
+    chaves dos argumentos de insert_expense.
     """
-    q = text("""
-        select chat_id
-        from public.expenses
-        where user_id = :user_id
-          and chat_id is not null
-          and chat_id <> ''
-        order by created_at desc
-        limit 1;
-    """)
+    if not rows:
+        return
     with engine.begin() as conn:
-        row = conn.execute(q, {"user_id": user_id}).first()
-
-    if not row or not row[0]:
-        return None
+        conn.execute(_Q_INSERT_MANY, rows)
 
-    try:
-        return int(row[0])
-    except Exception:
-        return None
 
+_Q_LIST_LAST_ENTRIES = text("""
+    select created_at, amount, currency, category, description
+    from public.expenses
+    where user_id = :user_id
+      and type = :type
+      and amount is not null
+    order by created_at desc
+    limit :limit;
+""")
 
 def list_last_entries(user_id: str, entry_type: str = "expense", limit: int = 10):
     """
     Lista ultimas entradas por tipo ('expense' ou 'income').
     """
-    q = text("""
-        select created_at, amount, currency, category, description
-        from public.expenses
-        where user_id = :user_id
-          and coalesce(type, 'expense') = :type
-        order by created_at desc
-        limit :limit;
-    """)
-    with engine.begin() as conn:
-        return conn.execute(q, {"user_id": user_id, "type": entry_type, "limit": limit}).fetchall()
+    with read_engine.connect() as conn:
+        return conn.execute(_Q_LIST_LAST_ENTRIES, {"user_id": user_id, "type": entry_type, "limit": limit}).fetchall()
 
 
 # Alias para retrocompatibilidade
@@ -101,151 +123,202 @@ def list_last_expenses(user_id: str, limit: int = 10):
     return list_last_entries(user_id, entry_type="expense", limit=limit)
 
 
-def totals_by_category(user_id: str, start_dt: datetime, end_dt: datetime, entry_type: str = "expense"):
-    q = text("""
-        select category, coalesce(sum(amount), 0) as total, count(*) as n
-        from public.expenses
-        where user_id = :user_id
-          and created_at >= :start_dt
-          and created_at < :end_dt
-          and amount is not null
-          and coalesce(type, 'expense') = :type
-        group by category
-        order by total desc;
-    """)
-    with engine.begin() as conn:
-        return conn.execute(q, {
-            "user_id": user_id, "start_dt": start_dt, "end_dt": end_dt, "type": entry_type,
+_Q_REPORT_BUNDLE = text("""
+    select
+        category,
+        coalesce(sum(amount) filter (where created_at >= :d_start and created_at < :d_end), 0) as day_total,
+        count(*) filter (where created_at >= :d_start and created_at < :d_end) as day_n,
+        coalesce(sum(amount) filter (where created_at >= :w_start and created_at < :w_end), 0) as week_total,
+        count(*) filter (where created_at >= :w_start and created_at < :w_end) as week_n
+    from public.expenses
+    where user_id = :user_id
+      and created_at >= least(:d_start, :w_start)
+      and created_at < greatest(:d_end, :w_end)
+      and amount is not null
+      and type = 'expense'
+    group by category;
+""")
+
+def report_bundle(user_id: str, d_start: datetime, d_end: datetime, w_start: datetime, w_end: datetime) -> dict:
+    """
+    Tudo que o /relatorio precisa numa consulta só: totais e categorias de
+    gastos do dia e da semana. Agrupa por categoria com FILTER por janela e
+    soma os totais gerais em Python.
+    Retorna {"day_total", "day_n", "week_total", "week_n", "day_rows", "week_rows"},
+    com as listas de (category, total, n) em ordem de total desc.
+    """
+    with read_engine.connect() as conn:
+        rows = conn.execute(_Q_REPORT_BUNDLE, {
+            "user_id": user_id, "d_start": d_start, "d_end": d_end, "w_start": w_start, "w_end": w_end,
         }).fetchall()
 
+    day_rows = sorted(((c, dt, dn) for c, dt, dn, _, _ in rows if dn), key=lambda r: r[1], reverse=True)
+    week_rows = sorted(((c, wt, wn) for c, _, _, wt, wn in rows if wn), key=lambda r: r[1], reverse=True)
+    return {
+        "day_total": sum(r[1] for r in day_rows),
+        "day_n": sum(r[2] for r in day_rows),
+        "week_total": sum(r[1] for r in week_rows),
+        "week_n": sum(r[2] for r in week_rows),
+        "day_rows": day_rows,
+        "week_rows": week_rows,
+    }
 
-def totals_overall(user_id: str, start_dt: datetime, end_dt: datetime, entry_type: str = "expense"):
-    q = text("""
-        select coalesce(sum(amount), 0) as total, count(*) as n
-        from public.expenses
-        where user_id = :user_id
-          and created_at >= :start_dt
-          and created_at < :end_dt
-          and amount is not null
-          and coalesce(type, 'expense') = :type;
-    """)
-    with engine.begin() as conn:
-        row = conn.execute(q, {
-            "user_id": user_id, "start_dt": start_dt, "end_dt": end_dt, "type": entry_type,
-        }).first()
-        if not row:
-            return 0, 0
-        return row[0], row[1]
+
+_Q_BULK_TOTALS = text("""
+    select
+        user_id,
+        category,
+        grouping(category) as is_total,
+        coalesce(sum(amount), 0) as total,
+        count(*) as n
+    from public.expenses
+    where created_at >= :start_dt
+      and created_at < :end_dt
+      and amount is not null
+      and type = :type
+    group by grouping sets ((user_id, category), (user_id))
+    order by user_id, is_total, total desc;
+""")
+
+def bulk_totals(start_dt: datetime, end_dt: datetime, entry_type: str = "expense") -> tuple[dict[str, tuple], dict[str, list]]:
+    """
+    Totais de todos os usuarios no intervalo numa consulta so: GROUPING SETS
+    agrega por (usuario, categoria) e por usuario na mesma passada.
+    Retorna ({user_id: (total, n)}, {user_id: [(category, total, n), ...]}),
+    com cada lista em ordem de total desc. Usuarios sem registros nao aparecem.
+    """
+    with read_engine.connect() as conn:
+        rows = conn.execute(_Q_BULK_TOTALS, {"start_dt": start_dt, "end_dt": end_dt, "type": entry_type}).fetchall()
+    overall: dict[str, tuple] = {}
+    by_category: dict[str, list] = {}
+    for user_id, category, is_total, total, n in rows:
+        # grouping() separa a linha de total de uma categoria NULL de verdade
+        if is_total:
+            overall[user_id] = (total, n)
+        else:
+            by_category.setdefault(user_id, []).append((category, total, n))
+    return overall, by_category
 
 
+# Dias e semanas sao agrupados no fuso do bot (:tz), nao no fuso da sessao
+# (UTC no Supabase): um gasto as 22h de Sao Paulo fica no proprio dia.
+# Exige created_at timestamptz (ver README); num timestamp sem fuso o
+# "at time zone" faria a conversao no sentido contrario.
+_Q_DAILY_TOTALS_LAST_N_DAYS = text("""
+    select (created_at at time zone :tz)::date as day, coalesce(sum(amount), 0) as total
+    from public.expenses
+    where user_id = :user_id
+      and created_at >= :start_dt
+      and created_at < :end_dt
+      and amount is not null
+      and type = :type
+    group by 1
+    order by 1 asc
+    limit :days;
+""")
+
 def daily_totals_last_n_days(user_id: str, days: int, start_dt: datetime, end_dt: datetime, entry_type: str = "expense"):
     """
-    Retorna totais por dia no intervalo [start_dt, end_dt).
+    Retorna (date, total) por dia local no intervalo [start_dt, end_dt).
     """
-    q = text("""
-        select date_trunc('day', created_at) as day, coalesce(sum(amount), 0) as total
-        from public.expenses
-        where user_id = :user_id
-          and created_at >= :start_dt
-          and created_at < :end_dt
-          and amount is not null
-          and coalesce(type, 'expense') = :type
-        group by 1
-        order by 1 asc
-        limit :days;
-    """)
-    with engine.begin() as conn:
-        return conn.execute(q, {
+    with read_engine.connect() as conn:
+        return conn.execute(_Q_DAILY_TOTALS_LAST_N_DAYS, {
             "user_id": user_id,
             "start_dt": start_dt,
             "end_dt": end_dt,
             "days": days,
             "type": entry_type,
+            "tz": TZ.key,
         }).fetchall()
 
 
+_Q_MONTHLY_BALANCE = text("""
+    select
+        coalesce(sum(amount) filter (where type = 'expense'), 0) as total_expense,
+        count(*) filter (where type = 'expense') as n_expense,
+        coalesce(sum(amount) filter (where type = 'income'), 0) as total_income,
+        count(*) filter (where type = 'income') as n_income
+    from public.expenses
+    where user_id = :user_id
+      and type in ('expense', 'income')
+      and created_at >= :start_dt
+      and created_at < :end_dt
+      and amount is not null;
+""")
+
 def monthly_balance(user_id: str, start_dt: datetime, end_dt: datetime):
     """
-    Retorna (total_gastos, n_gastos, total_ganhos, n_ganhos) no periodo.
+    Retorna (total_gastos, n_gastos, total_ganhos, n_ganhos) no periodo,
+    numa unica consulta (os totais vem como Decimal).
     """
-    q = text("""
-        select
-            coalesce(sum(case when coalesce(type, 'expense') = 'expense' then amount end), 0) as total_expense,
-            count(case when coalesce(type, 'expense') = 'expense' then 1 end) as n_expense,
-            coalesce(sum(case when type = 'income' then amount end), 0) as total_income,
-            count(case when type = 'income' then 1 end) as n_income
-        from public.expenses
-        where user_id = :user_id
-          and created_at >= :start_dt
-          and created_at < :end_dt
-          and amount is not null;
-    """)
-    with engine.begin() as conn:
-        row = conn.execute(q, {"user_id": user_id, "start_dt": start_dt, "end_dt": end_dt}).first()
+    with read_engine.connect() as conn:
+        row = conn.execute(_Q_MONTHLY_BALANCE, {"user_id": user_id, "start_dt": start_dt, "end_dt": end_dt}).first()
         if not row:
             return 0, 0, 0, 0
         return row[0], row[1], row[2], row[3]
 
 
+_Q_WEEKLY_BALANCE_LAST_N_WEEKS = text("""
+    select
+        date_trunc('week', created_at at time zone :tz) as week,
+        coalesce(sum(case when type = 'expense' then amount end), 0) as expenses,
+        coalesce(sum(case when type = 'income' then amount end), 0) as income
+    from public.expenses
+    where user_id = :user_id
+      and type in ('expense', 'income')
+      and created_at >= :start_dt
+      and created_at < :end_dt
+      and amount is not null
+    group by 1
+    order by 1 asc
+    limit :weeks;
+""")
+
 def weekly_balance_last_n_weeks(user_id: str, weeks: int, start_dt: datetime, end_dt: datetime):
     """
     Retorna gastos e ganhos agrupados por semana para o grafico de balanco.
     """
-    q = text("""
-        select
-            date_trunc('week', created_at) as week,
-            coalesce(sum(case when coalesce(type, 'expense') = 'expense' then amount end), 0) as expenses,
-            coalesce(sum(case when type = 'income' then amount end), 0) as income
-        from public.expenses
-        where user_id = :user_id
-          and created_at >= :start_dt
-          and created_at < :end_dt
-          and amount is not null
-        group by 1
-        order by 1 asc
-        limit :weeks;
-    """)
-    with engine.begin() as conn:
-        return conn.execute(q, {
+    with read_engine.connect() as conn:
+        return conn.execute(_Q_WEEKLY_BALANCE_LAST_N_WEEKS, {
             "user_id": user_id,
             "start_dt": start_dt,
             "end_dt": end_dt,
             "weeks": weeks,
+            "tz": TZ.key,
         }).fetchall()
 
 
-def list_users_with_expenses(only_with_chat_id: bool = True):
+_Q_LIST_USERS_AND_CHAT_IDS = text("""
+    select distinct on (user_id) user_id, chat_id
+    from public.expenses
+    where chat_id is not null and chat_id <> ''
+    order by user_id, created_at desc;
+""")
+
+def list_users_and_chat_ids() -> list[tuple[str, str]]:
     """
-    Lista usuários distintos. Se only_with_chat_id=True, só retorna usuários
-    que já têm chat_id salvo (necessário para envio automático).
+    (user_id, chat_id) de cada usuário com chat_id salvo, usando o chat_id
+    mais recente, numa consulta só.
     """
-    if only_with_chat_id:
-        q = text("""
-            select distinct user_id
-            from public.expenses
-            where chat_id is not null and chat_id <> '';
-        """)
-    else:
-        q = text("select distinct user_id from public.expenses;")
+    with read_engine.connect() as conn:
+        return [(r[0], r[1]) for r in conn.execute(_Q_LIST_USERS_AND_CHAT_IDS).fetchall()]
 
-    with engine.begin() as conn:
-        return [r[0] for r in conn.execute(q).fetchall()]
 
+_Q_DELETE_LAST_ENTRY = text("""
+    delete from public.expenses
+    where id = (
+        select id from public.expenses
+        where user_id = :user_id
+        order by created_at desc
+        limit 1
+    )
+    returning amount, category, description, type;
+""")
 
 def delete_last_entry(user_id: str):
     """
     Remove o último registro (gasto ou ganho) do usuário.
     Retorna os dados do item removido para confirmação.
     """
-    q = text("""
-        delete from public.expenses
-        where id = (
-            select id from public.expenses
-            where user_id = :user_id
-            order by created_at desc
-            limit 1
-        )
-        returning amount, category, description, type;
-    """)
     with engine.begin() as conn:
-        return conn.execute(q, {"user_id": user_id}).first()
+        return conn.execute(_Q_DELETE_LAST_ENTRY, {"user_id": user_id}).first()
@@ -2,8 +2,9 @@
 Testes unitarios para funcoes puras do bot.
 Roda com: pytest tests/ -v
 """
-import pytz
 from datetime import datetime, timedelta
+from decimal import Decimal
+from zoneinfo import ZoneInfo
 
 import sys, os
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
@@ -14,10 +15,14 @@ from utils import (
     day_range_local,
     week_range_local,
     CATEGORY_EMOJI,
+    TTLCache,
+    TokenBucket,
+    may_have_amount,
+    fast_extract,
 )
 
 
-TZ = pytz.timezone("America/Sao_Paulo")
+TZ = ZoneInfo("America/Sao_Paulo")
 
 
 # ─── format_brl ───────────────────────────────────────────────
@@ -51,6 +56,21 @@ class TestFormatBrl:
         result = format_brl(-50)
         assert "50" in result
 
+    def test_mesmo_valor_em_tipos_diferentes(self):
+        # int, float e Decimal iguais (inclusive -0.0) tem que dar o mesmo texto,
+        # em qualquer ordem de chamada
+        for values, expected in (
+            ((-0.0, Decimal("-0.00"), 0, 0.0, Decimal("0")), "R$ 0,00"),
+            ((0, -0.0, Decimal("-0.00")), "R$ 0,00"),
+            ((1234.5, Decimal("1234.50"), 1234.5), "R$ 1.234,50"),
+            ((50, 50.0, Decimal("50")), "R$ 50,00"),
+        ):
+            for value in values:
+                assert format_brl(value) == expected, value
+
+    def test_valor_nao_hashable(self):
+        assert format_brl([1]) == "R$ [1]"
+
 
 # ─── format_reply ─────────────────────────────────────────────
 
@@ -101,6 +121,12 @@ class TestFormatReply:
         assert "<b>" in result
         assert "<i>" in result
 
+    def test_descricao_escapa_html(self):
+        obj = {"amount": 15, "category": "lazer", "description": "pipoca <3 & refri", "type": "expense"}
+        result = format_reply(obj)
+        assert "pipoca &lt;3 &amp; refri" in result
+        assert "🎮" in result
+
 
 # ─── day_range_local ──────────────────────────────────────────
 
@@ -159,3 +185,124 @@ class TestCategoryEmoji:
     def test_emoji_nao_vazio(self):
         for cat, emoji in CATEGORY_EMOJI.items():
             assert len(emoji) > 0, f"Emoji vazio para '{cat}'"
+
+
+# ─── may_have_amount ──────────────────────────────────────────
+
+class TestMayHaveAmount:
+    def test_mensagens_com_valor(self):
+        for msg in ("gastei 50 no uber", "almocei trinta reais", "Recebi o salario", "R$ 20 pizza"):
+            assert may_have_amount(msg), msg
+
+    def test_mensagens_sem_valor(self):
+        for msg in ("oi", "obrigado!", "kkkk", "bom dia"):
+            assert not may_have_amount(msg), msg
+
+    def test_acento_e_numero_por_extenso(self):
+        for msg in ("Recebi o salário", "salário caiu", "vinte no lanche", "trinta de uber",
+                    "cem pro café", "mil", "três e cinquenta o pão", "um milhão", "duzentos na feira"):
+            assert may_have_amount(msg), msg
+
+    def test_palavras_parecidas_nao_contam(self):
+        for msg in ("biscoito", "setembro chegou", "que legal", "tudo certo?", "desconto"):
+            assert not may_have_amount(msg), msg
+
+
+# ─── fast_extract ─────────────────────────────────────────────
+
+class TestFastExtract:
+    def test_frase_simples(self):
+        obj = fast_extract("Gastei R$ 12,50 na padaria.")
+        assert obj["amount"] == 12.5
+        assert obj["category"] == "alimentacao"
+        assert obj["description"] == "padaria"
+        assert obj["type"] == "expense"
+
+    def test_verbo_define_categoria(self):
+        obj = fast_extract("almocei 35")
+        assert obj["category"] == "alimentacao"
+        assert obj["description"] == "almoço"
+
+    def test_casos_ambiguos_vao_pra_ia(self):
+        for msg in ("paguei 1.200 de aluguel", "gastei 30 em coisas", "gastei 50",
+                    "recebi 300 de salario", "gastei 50 no uber e 20 no lanche"):
+            assert fast_extract(msg) is None, msg
+
+    def test_grandeza_ou_moeda_estrangeira_vao_pra_ia(self):
+        for msg in ("paguei 3 mil de aluguel", "gastei 2 mil no mercado", "paguei 1,5 mil de aluguel",
+                    "gastei 50 centavos no cafe", "paguei 20 dolares no uber", "gastei 100 usd no bar",
+                    "paguei 30 de mil coisas no mercado", "gastei 10 em euros no bar"):
+            assert fast_extract(msg) is None, msg
+
+    def test_unidade_nao_corta_descricao(self):
+        obj = fast_extract("gastei 50 contos no bar")
+        assert obj["amount"] == 50.0
+        assert obj["description"] == "bar"
+        assert obj["category"] == "lazer"
+
+
+# ─── TTLCache ─────────────────────────────────────────────────
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache:
+    def test_hit_dentro_do_ttl(self):
+        clock = FakeClock()
+        cache = TTLCache(ttl=60, clock=clock)
+        cache.set(("u1", 1), "relatorio")
+        clock.now = 59
+        assert cache.get(("u1", 1)) == "relatorio"
+        assert cache.hits == 1
+
+    def test_expira_apos_ttl(self):
+        clock = FakeClock()
+        cache = TTLCache(ttl=60, clock=clock)
+        cache.set(("u1", 1), "relatorio")
+        clock.now = 60
+        assert cache.get(("u1", 1)) is None
+        assert cache.misses == 1
+        assert len(cache) == 0
+
+    def test_respeita_maxsize(self):
+        cache = TTLCache(ttl=60, maxsize=2)
+        cache.set(("u1",), 1)
+        cache.set(("u2",), 2)
+        cache.set(("u3",), 3)
+        assert len(cache) == 2
+        assert cache.get(("u1",)) is None
+        assert cache.get(("u3",)) == 3
+
+    def test_invalida_so_o_usuario(self):
+        cache = TTLCache(ttl=60)
+        cache.set(("u1", 1), "a")
+        cache.set(("u1", 2), "b")
+        cache.set(("u2", 1), "c")
+        cache.invalidate_user("u1")
+        assert cache.get(("u1", 1)) is None
+        assert cache.get(("u1", 2)) is None
+        assert cache.get(("u2", 1)) == "c"
+
+
+# ─── TokenBucket ──────────────────────────────────────────────
+
+class TestTokenBucket:
+    def test_esgota_e_bloqueia(self):
+        bucket = TokenBucket(5, 0.0)
+        assert all(bucket.consume(5 / 60, 5, 0.0) for _ in range(5))
+        assert bucket.consume(5 / 60, 5, 0.0) is False
+
+    def test_repoe_com_o_tempo(self):
+        bucket = TokenBucket(0, 0.0)
+        assert bucket.consume(5 / 60, 5, 6.0) is False
+        assert bucket.consume(5 / 60, 5, 12.0) is True
+
+    def test_nao_passa_do_teto(self):
+        bucket = TokenBucket(5, 0.0)
+        bucket.consume(5 / 60, 5, 3600.0)
+        assert bucket.tokens == 4
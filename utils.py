@@ -2,10 +2,15 @@
 Funcoes utilitarias puras — sem dependencias externas pesadas.
 Podem ser importadas em testes sem carregar telegram/db/etc.
 """
-import pytz
+import functools
+import re
+import threading
+import time
+import unicodedata
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 
-TZ = pytz.timezone("America/Sao_Paulo")
+TZ = ZoneInfo("America/Sao_Paulo")
 
 CATEGORY_EMOJI: dict[str, str] = {
     "alimentacao": "🍔",
@@ -24,54 +29,245 @@ def now_local() -> datetime:
     return datetime.now(TZ)
 
 
+# timedeltas fixos, criados uma vez: recuo ate a segunda-feira por weekday()
+_ONE_DAY = timedelta(days=1)
+_ONE_WEEK = timedelta(days=7)
+_BACK_TO_MONDAY = tuple(timedelta(days=i) for i in range(7))
+
+
 def day_range_local(d: datetime) -> tuple[datetime, datetime]:
     start = d.replace(hour=0, minute=0, second=0, microsecond=0)
-    end = start + timedelta(days=1)
-    return start, end
+    return start, start + _ONE_DAY
 
 
 def week_range_local(d: datetime) -> tuple[datetime, datetime]:
-    start = d.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=d.weekday())
-    end = start + timedelta(days=7)
-    return start, end
+    start = d.replace(hour=0, minute=0, second=0, microsecond=0) - _BACK_TO_MONDAY[d.weekday()]
+    return start, start + _ONE_WEEK
+
+
+# troca "," <-> "." numa passada so (1,234.56 -> 1.234,56)
+_BRL_SEPARATORS = str.maketrans(",.", ".,")
+
+
+# Os mesmos valores se repetem muito (aluguel, salario, ticks dos graficos),
+# entao o resultado fica num LRU. A chave e o float ja normalizado: o LRU
+# compara por ==, e 0.0, -0.0 e Decimal("-0.00") cairiam na mesma entrada
+# com textos diferentes; o "+ 0.0" transforma -0.0 em 0.0.
+@functools.lru_cache(maxsize=4096)
+def _format_brl_float(amount_f: float) -> str:
+    return f"R$ {amount_f:,.2f}".translate(_BRL_SEPARATORS)
 
 
 def format_brl(amount: float | int | str) -> str:
     try:
-        amount_f = float(amount)
-        return f"R$ {amount_f:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+        amount_f = float(amount) + 0.0
     except Exception:
         return f"R$ {amount}"
+    return _format_brl_float(amount_f)
+
+
+# Escape pro parse_mode="HTML" do Telegram numa passada so (str.translate).
+# Descricao e categoria vem do usuario/IA e podem ter "<", ">" ou "&".
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+
+def escape_html(text) -> str:
+    return str(text).translate(_HTML_ESCAPE)
+
+
+_REPLY_NAO_ENTENDI = (
+    "😅 <b>Não entendi</b>\n\n"
+    "Tenta algo como:\n"
+    "  <code>gastei 50 no uber</code>\n"
+    "  <code>recebi 3000 de salario</code>"
+)
+_REPLY_HEADER = {"income": "🟢 <b>Ganho registrado!</b>", "expense": "🔴 <b>Gasto registrado!</b>"}
 
 
 def format_reply(obj: dict) -> str:
     amount = obj.get("amount")
-    category = obj.get("category", "outros")
-    entry_type = obj.get("type", "expense")
-    desc = (obj.get("description") or "").strip() or ("Gasto" if entry_type == "expense" else "Ganho")
-    emoji = CATEGORY_EMOJI.get(category, "📦")
-
     if amount is None:
-        return (
-            "😅 <b>Não entendi</b>\n\n"
-            "Tenta algo como:\n"
-            "  <code>gastei 50 no uber</code>\n"
-            "  <code>recebi 3000 de salario</code>"
-        )
-
-    if entry_type == "income":
-        return (
-            f"🟢 <b>Ganho registrado!</b>\n"
-            f"\n"
-            f"💰 Valor: <b>{format_brl(amount)}</b>\n"
-            f"{emoji} Categoria: <b>{category}</b>\n"
-            f"📝 Descrição: <i>{desc}</i>"
-        )
+        return _REPLY_NAO_ENTENDI
 
+    raw_category = obj.get("category", "outros")
+    entry_type = obj.get("type", "expense")
+    desc = escape_html((obj.get("description") or "").strip() or ("Gasto" if entry_type == "expense" else "Ganho"))
+
+    # f-string direto: mais rapido que um template com str.format
     return (
-        f"🔴 <b>Gasto registrado!</b>\n"
+        f"{_REPLY_HEADER.get(entry_type, _REPLY_HEADER['expense'])}\n"
         f"\n"
         f"💰 Valor: <b>{format_brl(amount)}</b>\n"
-        f"{emoji} Categoria: <b>{category}</b>\n"
+        f"{CATEGORY_EMOJI.get(raw_category, '📦')} Categoria: <b>{escape_html(raw_category)}</b>\n"
         f"📝 Descrição: <i>{desc}</i>"
     )
+
+
+# Pista barata de que a mensagem fala de dinheiro: algum digito, valor por
+# extenso ou verbo/palavra tipica de gasto/ganho. Sem nada disso ("oi",
+# "obrigado", "kkkk") nem vale chamar a IA. Falso positivo so custa a chamada.
+# O texto chega sem acento (ver _strip_accents), entao a regex so tem a forma
+# sem acento ("salario", "tres", "milhao").
+_MONEY_HINT_RE = re.compile(
+    r"\d|r\$|\breais\b|\breal\b|\bconto|\bpila|\bcentavo|\bmilh(?:ao|oes)\b"
+    r"|\b(?:dois|duas|tres|quatro|cinco|seis|sete|oito|nove|dez|onze|doze|treze|catorze|quatorze"
+    r"|quinze|dezesseis|dezessete|dezoito|dezenove|vinte|trinta|quarenta|cinquenta|sessenta"
+    r"|setenta|oitenta|noventa|cem|mil)\b"
+    r"|\b(?:cento|duzent|trezent|quatrocent|quinhent|seiscent|setecent|oitocent|novecent)"
+    r"|gast|compr|pag|almoc|jant|merend|uber|mercado|receb|ganh|salari|pix",
+    re.IGNORECASE,
+)
+
+
+def _strip_accents(text: str) -> str:
+    if text.isascii():
+        return text
+    return "".join(ch for ch in unicodedata.normalize("NFD", text) if not unicodedata.combining(ch))
+
+
+def may_have_amount(text: str) -> bool:
+    return _MONEY_HINT_RE.search(_strip_accents(text)) is not None
+
+
+# ── Extracao rapida (sem IA) ──────────────────────────────────
+# Cobre so o formato mais comum, "<verbo> <valor> [reais] [no/na/em... <descricao>]",
+# quando da pra saber a categoria por palavra-chave. Qualquer duvida (valor
+# com milhar, sem descricao, categoria desconhecida) fica pra IA.
+# Depois do valor (e da unidade, se houver) so vale preposicao ou fim da
+# frase: "3 mil de aluguel", "50 centavos", "20 dolares" nao casam.
+_FAST_RE = re.compile(
+    r"^\s*(gastei|paguei|comprei|almocei|jantei)\s+(?:r\$\s*)?"
+    r"(\d+(?:[.,]\d{1,2})?)(?![.,]?\d)(?:\s*(?:reais|real|contos?|pila)\b)?"
+    r"(?:\s+(?:no|na|nos|nas|em|de|do|da|com)\s+(.*?))?[\s.!]*$",
+    re.IGNORECASE,
+)
+
+# Grandeza, subunidade ou moeda estrangeira logo apos o valor: a IA converte
+_FAST_REJECT_WORDS = frozenset({
+    "mil", "milhao", "milhão", "milhoes", "milhões", "centavo", "centavos",
+    "dolar", "dólar", "dolares", "dólares", "usd", "us$", "euro", "euros", "eur",
+})
+
+_VERB_CATEGORY = {"almocei": "alimentacao", "jantei": "alimentacao"}
+_VERB_DESCRIPTION = {"almocei": "almoço", "jantei": "jantar"}
+
+_KEYWORD_CATEGORY = {
+    "uber": "transporte", "taxi": "transporte", "táxi": "transporte",
+    "onibus": "transporte", "ônibus": "transporte", "metro": "transporte", "metrô": "transporte",
+    "gasolina": "transporte", "combustivel": "transporte", "combustível": "transporte",
+    "estacionamento": "transporte",
+    "mercado": "alimentacao", "supermercado": "alimentacao", "ifood": "alimentacao",
+    "lanche": "alimentacao", "pizza": "alimentacao", "padaria": "alimentacao",
+    "restaurante": "alimentacao", "almoço": "alimentacao", "almoco": "alimentacao",
+    "jantar": "alimentacao", "cafe": "alimentacao", "café": "alimentacao", "acai": "alimentacao",
+    "açaí": "alimentacao",
+    "farmacia": "saude", "farmácia": "saude", "remedio": "saude", "remédio": "saude",
+    "medico": "saude", "médico": "saude", "consulta": "saude", "dentista": "saude",
+    "cinema": "lazer", "netflix": "lazer", "spotify": "lazer", "show": "lazer", "bar": "lazer",
+    "jogo": "lazer",
+    "aluguel": "casa", "luz": "casa", "energia": "casa", "agua": "casa", "água": "casa",
+    "internet": "casa", "condominio": "casa", "condomínio": "casa", "gas": "casa", "gás": "casa",
+}
+
+
+def fast_extract(text: str) -> dict | None:
+    """
+    Extrai gasto de frases simples ("gastei 50 no uber", "almocei 35") no
+    mesmo formato da resposta da IA. Retorna None quando nao tem certeza.
+    """
+    m = _FAST_RE.match(text)
+    if not m:
+        return None
+    verb, raw_amount, desc = m.group(1).lower(), m.group(2), (m.group(3) or "").strip()
+    if any(ch.isdigit() for ch in desc):
+        return None  # mais de um valor na frase: deixa pra IA
+    words = desc.lower().split()
+    if words and words[0] in _FAST_REJECT_WORDS:
+        return None
+    desc = _VERB_DESCRIPTION.get(verb) or desc
+    if not desc:
+        return None
+
+    category = _VERB_CATEGORY.get(verb)
+    if category is None:
+        for word in words:
+            category = _KEYWORD_CATEGORY.get(word)
+            if category:
+                break
+        else:
+            return None
+
+    return {
+        "type": "expense",
+        "amount": float(raw_amount.replace(",", ".")),
+        "currency": "BRL",
+        "category": category,
+        "description": " ".join(desc.split()[:6]),
+        "confidence": 0.9,
+    }
+
+
+class TTLCache:
+    """
+    Cache em memoria com expiracao por tempo e tamanho maximo.
+    As chaves sao tuplas cujo primeiro item e o user_id, o que permite
+    invalidar tudo de um usuario quando ele registra/remove algo.
+    Thread-safe: os builders rodam via asyncio.to_thread.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 256, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._data: dict[tuple, tuple[float, object]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple, default=None):
+        now = self._clock()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] <= now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: tuple, value) -> None:
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.maxsize:
+                # descarta a entrada mais antiga (ordem de insercao)
+                self._data.pop(next(iter(self._data)))
+            self._data[key] = (self._clock() + self.ttl, value)
+
+    def invalidate_user(self, user_id: str) -> None:
+        with self._lock:
+            for key in [k for k in self._data if k[0] == user_id]:
+                del self._data[key]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class TokenBucket:
+    """
+    Token bucket de um usuario: comeca cheio com `tokens` fichas e repoe
+    `rate` fichas por segundo ate o teto `cap`. Cada mensagem gasta uma.
+    """
+
+    __slots__ = ("tokens", "ts")
+
+    def __init__(self, tokens: float, ts: float):
+        self.tokens = tokens
+        self.ts = ts
+
+    def consume(self, rate: float, cap: float, now: float) -> bool:
+        self.tokens = min(cap, self.tokens + (now - self.ts) * rate)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False